@@ -7,32 +7,59 @@ Servidor de Cronograma (produção)
 - Modo MCP stdio opcional via CRONOGRAMA_RUN_MODE=stdio (para execução por cliente MCP)
 """
 
+import io
 import os
 import sys
 import re
+import math
 import unicodedata
 import logging
 import base64
-import secrets
+import hashlib
 import asyncio
+import heapq
 import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, Any, Optional, Tuple, List
-
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from urllib.parse import quote
+from xml.sax.saxutils import escape as xml_escape
+from typing import Dict, Any, Optional, Tuple, List, Literal, Union, BinaryIO, Iterator
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 import uvicorn
+import orjson
 
 # MCP (opcional)
 from mcp.server.fastmcp import FastMCP
 
-# XLSX
+# XLSX (lxml obrigatório: openpyxl usa lxml.etree.xmlfile no modo write_only)
+import lxml  # noqa: F401
+import openpyxl.xml
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles.cell_style import StyleArray
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 
+# pyexcelerate (opcional): writer XLSX mais rápido; openpyxl segue como fallback
+try:
+    import pyexcelerate
+    from pyexcelerate.Border import Border as PxBorder
+    from pyexcelerate.Borders import Borders as PxBorders
+except ImportError:
+    pyexcelerate = None
+
 # Pydantic (essencial pro OpenAPI "travar" requestBody)
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError, field_validator
 from typing_extensions import Annotated
 
 
@@ -54,9 +81,26 @@ TTL_MINUTES = int(os.getenv("CRONOGRAMA_TTL_MINUTES", "30"))
 BASE_URL = os.getenv("CRONOGRAMA_BASE_URL", "http://localhost:8000").rstrip("/")
 HTTP_PORT = int(os.getenv("CRONOGRAMA_HTTP_PORT", "8000"))
 
-# http (padrão) | stdio (apenas quando cliente MCP spawnar)
+# http (padrão) | stdio (apenas quando cliente MCP spawnar) | dual/both (stdio + HTTP no mesmo processo)
 RUN_MODE = os.getenv("CRONOGRAMA_RUN_MODE", "http").strip().lower()
 
+# Engine de escrita do XLSX: pyexcelerate (padrão, se instalado) | openpyxl | xml (zip + XML direto)
+XLSX_ENGINE = os.getenv("CRONOGRAMA_XLSX_ENGINE", "pyexcelerate").strip().lower()
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Download servido pelo proxy (nginx X-Accel-Redirect): o app só valida o token
+USE_XACCEL = os.getenv("CRONOGRAMA_USE_XACCEL", "false").strip().lower() in ("1", "true", "yes")
+XACCEL_PREFIX = "/" + os.getenv("CRONOGRAMA_XACCEL_PREFIX", "/_internal/").strip("/") + "/"
+
+# Access log do uvicorn (uma linha por request): desligado por padrão
+ACCESS_LOG = os.getenv("CRONOGRAMA_ACCESS_LOG", "false").strip().lower() in ("1", "true", "yes")
+
+# Máximo de cronogramas por chamada de lote (gerar_xlsx_lote / /cronograma/generate/batch)
+MAX_BATCH = int(os.getenv("CRONOGRAMA_MAX_BATCH", "20"))
+
+# Cache de resultado: payload idêntico (no mesmo dia) reaproveita o XLSX já gerado. 0 desliga
+RESULT_CACHE_SIZE = int(os.getenv("CRONOGRAMA_RESULT_CACHE_SIZE", "256"))
+
 # Cleanup periódico (segundos)
 CLEANUP_INTERVAL_SECONDS = int(os.getenv("CRONOGRAMA_CLEANUP_INTERVAL_SECONDS", "60"))
 
@@ -64,7 +108,23 @@ OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 # Registry: token -> {filepath, filename, expires_at}
 file_registry: Dict[str, Dict[str, Any]] = {}
+# Min-heap (expires_at, token): o topo é sempre o próximo a expirar
+_expiry_heap: List[Tuple[datetime, str]] = []
 registry_lock = threading.Lock()
+# Tokens vivos por arquivo: o mesmo XLSX pode estar atrás de vários tokens (cache de
+# resultado, mesmo projeto regerado no dia); o arquivo só sai do disco com o último
+_file_refs: Dict[str, int] = {}
+# Gerações em andamento por arquivo (reservadas antes de escrever): enquanto houver uma,
+# o cleanup não remove o caminho, mesmo que o último token dele acabe de expirar
+_file_pending: Dict[str, int] = {}
+# Cache de resultado (LRU): chave do payload -> {filepath, file_id, summary, project_total_hours}
+_result_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+# Pool de tokens: um único os.urandom por lote em vez de uma syscall por token
+TOKEN_BYTES = 32
+TOKEN_BATCH = 64
+_token_pool: deque = deque()
+_token_lock = threading.Lock()
 
 
 # ========================================================
@@ -94,6 +154,13 @@ class SettingsModel(BaseModel):
     sheet_name: Optional[str] = Field(default="Planilha1")
     include_project_row: Optional[bool] = Field(default=True)
     max_rows: Optional[int] = Field(default=None, ge=1, description="Override do limite de linhas")
+    include_base64: Optional[bool] = Field(default=False, description="Inclui o XLSX em base64 na resposta (padrão: só download_url)")
+    engine: Optional[Literal["pyexcelerate", "openpyxl", "xml"]] = Field(default=None, description="Override da engine de escrita do XLSX")
+
+    @field_validator("sheet_name")
+    @classmethod
+    def _normalize_sheet_name(cls, v: Optional[str]) -> Optional[str]:
+        return None if v is None else normalize_sheet_name(v)
 
 class PayloadModel(BaseModel):
     model_config = ConfigDict(extra="allow")
@@ -101,11 +168,49 @@ class PayloadModel(BaseModel):
     macros: List[MacroModel] = Field(..., min_length=1)
     settings: Optional[SettingsModel] = Field(default=None)
 
+class BatchPayloadModel(BaseModel):
+    # itens crus: cada um é validado contra PayloadModel separadamente, para que um
+    # item inválido vire erro no próprio resultado em vez de um 422 do lote inteiro
+    # (inclusive não-objetos). O schema do OpenAPI continua apontando cada item para PayloadModel
+    payloads: List[Any] = Field(
+        ...,
+        min_length=1,
+        description="Cronogramas a gerar (até CRONOGRAMA_MAX_BATCH), cada um no formato de PayloadModel",
+        json_schema_extra={"items": {"$ref": "#/components/schemas/PayloadModel"}},
+    )
+
 
 # ========================================================
 # UTIL
 # ========================================================
 
+# sanitize_filename: separadores viram espaço; inválidos do Windows/headers e controles são removidos
+_FILENAME_TRANSLATE = str.maketrans({
+    "/": " ",
+    "-": " ",
+    **dict.fromkeys('<>:"\\|?*' + "".join(chr(i) for i in range(32))),
+})
+_RE_SPACES = re.compile(r"\s+")
+_RE_UNSAFE = re.compile(r"[^A-Za-z0-9._-]")
+_RE_MULTI_UNDERSCORE = re.compile(r"_+")
+_RE_SURROGATE = re.compile("[\ud800-\udfff]")
+
+# título de aba: o Excel recusa []:*?/\ (e controles), aspas simples nas pontas e mais de 31 caracteres;
+# U+FFFE/U+FFFF e surrogates soltos também saem (inválidos no XML do workbook)
+SHEET_NAME_DEFAULT = "Planilha1"
+SHEET_NAME_MAX = 31
+_SHEET_NAME_TRANSLATE = str.maketrans(dict.fromkeys(
+    "[]:*?/\\\ufffe\uffff"
+    + "".join(chr(i) for i in range(32))
+    + "".join(chr(i) for i in range(0xD800, 0xE000))
+))
+
+def payload_settings(payload: dict) -> dict:
+    """settings do payload (um único lookup); {} se ausente ou inválido."""
+    settings = payload.get("settings")
+    return settings if isinstance(settings, dict) else {}
+
+
 def sanitize_filename(name: str) -> str:
     """Gera nome de arquivo seguro (ASCII) e previsível.
 
@@ -117,93 +222,260 @@ def sanitize_filename(name: str) -> str:
     """
     if not name:
         return "Cronograma"
+    return _sanitize_filename_cached(str(name))
+
 
+# o mesmo projeto costuma ser regenerado várias vezes: memoiza o resultado
+@lru_cache(maxsize=256)
+def _sanitize_filename_cached(name: str) -> str:
     # Normaliza e remove acentos (vira ASCII)
-    n = unicodedata.normalize("NFKD", str(name))
+    n = unicodedata.normalize("NFKD", name)
     n = n.encode("ascii", "ignore").decode("ascii")
 
-    # Troca separadores comuns por espaço (antes de virar underscore)
-    n = n.replace("->", " ").replace("=>", " ").replace("/", " ")
-    n = n.replace("-", " ").replace("—", " ").replace("–", " ")
-
-    # Remove caracteres inválidos do Windows/headers e controles
-    n = re.sub(r'[<>:"/\\|?*\x00-\x1f]', "", n)
+    # Troca separadores comuns por espaço e remove inválidos/controles (um passe em C).
+    # "=>" precisa vir antes: ">" sozinho é removido.
+    # ("—"/"–" já sumiram no encode ASCII; "->" é coberto por "-" + remoção de ">")
+    n = n.replace("=>", " ").translate(_FILENAME_TRANSLATE)
 
     # Espaços -> underscore e limpa
-    n = re.sub(r"\s+", "_", n).strip("_")
+    n = _RE_SPACES.sub("_", n).strip("_")
 
     # Mantém somente caracteres seguros
-    n = re.sub(r"[^A-Za-z0-9._-]", "", n)
+    n = _RE_UNSAFE.sub("", n)
 
     # Evita múltiplos underscores
-    n = re.sub(r"_+", "_", n)
+    n = _RE_MULTI_UNDERSCORE.sub("_", n)
 
     return n[:180] if n else "Cronograma"
 
 
+@lru_cache(maxsize=256)
+def normalize_sheet_name(name: str) -> str:
+    """Título de aba aceito por Excel/openpyxl: remove inválidos, apara e limita a 31 caracteres."""
+    n = str(name).translate(_SHEET_NAME_TRANSLATE).strip().strip("'")
+    n = n[:SHEET_NAME_MAX].rstrip().rstrip("'")
+    return n or SHEET_NAME_DEFAULT
+
+
+# "MM:SS" pré-formatado para cada resto de segundos dentro da hora (0..3599)
+_MMSS = tuple(f"{m:02d}:{s:02d}" for m in range(60) for s in range(60))
+
+# puro e com poucos valores distintos por cronograma (1.0, 0.5, 4...): memoiza.
+# A chave é o valor exato (sem round): arredondar a chave poderia mudar o segundo exibido
+@lru_cache(maxsize=4096)
 def hours_to_duration_display(hours: float) -> str:
     """
     Converte horas decimais para HHH:MM:SS (sem virar dias).
     Ex: 247.6667 -> 247:40:00
     """
-    if hours is None or hours < 0:
-        hours = 0.0
-    total_seconds = int(round(hours * 3600))
-    h = total_seconds // 3600
-    m = (total_seconds % 3600) // 60
-    s = total_seconds % 60
-    return f"{h:d}:{m:02d}:{s:02d}"
+    if not hours or hours < 0:
+        return "0:00:00"
+    # horas inteiras (caso comum: 4, 8, 8.0...): sem aritmética de segundos.
+    # type() e não isinstance(): bool é subclasse de int
+    if type(hours) is int:
+        return f"{hours}:00:00"
+    if type(hours) is float and hours.is_integer():
+        return f"{int(hours)}:00:00"
+    # hours > 0: +0.5 e truncar arredonda para o segundo mais próximo
+    total_seconds = int(hours * 3600 + 0.5)
+    h, rem = divmod(total_seconds, 3600)
+    return f"{h}:{_MMSS[rem]}"
+
+def xlsx_download_name(project_name: str) -> str:
+    """Nome exibido ao usuário (campo filename e Content-Disposition do download)."""
+    project_name_clean = sanitize_filename(project_name)
+    timestamp = datetime.now().strftime("%Y-%m-%d")
+    return f"Cronograma_-_{project_name_clean}_-_{timestamp}.xlsx"
+
+def xlsx_output_path(project_name: str, digest: Optional[str] = None) -> Path:
+    """
+    Caminho em disco. Com digest (hash do payload), payloads diferentes com o mesmo
+    nome de projeto nunca dividem arquivo: um não sobrescreve o download do outro.
+    """
+    name = xlsx_download_name(project_name)
+    if digest:
+        name = f"{name[:-len('.xlsx')]}_{digest}.xlsx"
+    return OUTPUT_DIR / name
+
+def _refill_tokens() -> None:
+    raw = os.urandom(TOKEN_BYTES * TOKEN_BATCH)
+    _token_pool.extend(
+        base64.urlsafe_b64encode(raw[i:i + TOKEN_BYTES]).rstrip(b"=").decode("ascii")
+        for i in range(0, len(raw), TOKEN_BYTES)
+    )
+
+@contextmanager
+def atomic_output(final_path: Path) -> Iterator[Path]:
+    """
+    Entrega um temporário no mesmo diretório de final_path e, se o bloco terminar bem,
+    publica com os.replace (rename atômico no mesmo filesystem): nunca aparece XLSX
+    parcial em OUTPUT_DIR, nem um download pega o arquivo no meio de uma regeração.
+    """
+    # nome único por processo/thread; criado pela própria engine, então respeita o umask
+    # (mkstemp criaria 0600 e o nginx do X-Accel-Redirect não conseguiria ler)
+    tmp_path = final_path.with_name(f".{final_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, final_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+def write_atomic(final_path: Path, data: Union[bytes, memoryview]) -> Tuple[int, int, int]:
+    """
+    Publica data em final_path via atomic_output e retorna a identidade (ino, mtime_ns, size)
+    do que ESTA chamada escreveu: o fstat é feito no temporário antes do rename (que preserva
+    o inode), então um rename concorrente no mesmo caminho não contamina o resultado.
+    """
+    with atomic_output(final_path) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            st = os.fstat(f.fileno())
+    return st.st_ino, st.st_mtime_ns, st.st_size
 
 def generate_token() -> str:
-    return secrets.token_urlsafe(32)
+    # Mesmo formato de secrets.token_urlsafe(32); o lock evita refill duplo entre threads
+    with _token_lock:
+        if not _token_pool:
+            _refill_tokens()
+        return _token_pool.popleft()
+
+def _register_token_locked(filepath: Path, filename: Optional[str] = None) -> Tuple[str, datetime]:
+    """Registra um token novo para filepath (filename: nome exibido no download). Chamar com registry_lock."""
+    token = generate_token()
+    expires_at = datetime.now() + timedelta(minutes=TTL_MINUTES)
+    file_registry[token] = {
+        "filepath": str(filepath),
+        "filename": filename or filepath.name,
+        "expires_at": expires_at,
+    }
+    heapq.heappush(_expiry_heap, (expires_at, token))
+    _file_refs[str(filepath)] = _file_refs.get(str(filepath), 0) + 1
+    return token, expires_at
+
+def _release_token_locked(token: str) -> Optional[Dict[str, Any]]:
+    """
+    Tira o token do registry. Chamar com registry_lock.
+    Retorna o info só se era o último token do arquivo (quem chamou remove com _unlink_if_unreferenced).
+    """
+    info = file_registry.pop(token, None)
+    if info is None:
+        return None
+    path = info["filepath"]
+    refs = _file_refs.get(path, 1) - 1
+    if refs > 0:
+        _file_refs[path] = refs
+        return None
+    _file_refs.pop(path, None)
+    return info
+
+def _reserve_path_locked(filepath: Path) -> None:
+    """Marca uma geração em andamento para filepath. Chamar com registry_lock, antes de escrever."""
+    path = str(filepath)
+    _file_pending[path] = _file_pending.get(path, 0) + 1
+
+def _unreserve_path_locked(filepath: Path) -> None:
+    """Encerra a reserva de _reserve_path_locked (após registrar o token ou em caso de erro)."""
+    path = str(filepath)
+    pending = _file_pending.get(path, 1) - 1
+    if pending > 0:
+        _file_pending[path] = pending
+    else:
+        _file_pending.pop(path, None)
+
+def _unlink_if_unreferenced(filepath: Path) -> bool:
+    """
+    Remove filepath do disco se nenhum token nem geração em andamento o referenciar.
+    A checagem e o unlink acontecem sob o mesmo registry_lock: a regeração do mesmo
+    payload (mesmo caminho) reserva o caminho sob o lock antes de escrever, então
+    nunca tem o arquivo novo apagado por um cleanup que liberou o token anterior.
+    """
+    path = str(filepath)
+    with registry_lock:
+        if path in _file_refs or path in _file_pending:
+            return False
+        try:
+            filepath.unlink()
+        except FileNotFoundError:
+            return False
+    return True
 
 def cleanup_expired_files() -> None:
+    """Remove arquivos expirados consumindo o heap até o primeiro token ainda válido.
+
+    Fase 1 (com lock): tira os expirados do registry.
+    Fase 2: unlink arquivo a arquivo via _unlink_if_unreferenced (lock só por arquivo,
+    re-checando referências), sem segurar /download e novos registros pela varredura toda.
+    """
     now = datetime.now()
-    expired_tokens: List[str] = []
+    expired: List[Dict[str, Any]] = []
 
     with registry_lock:
-        for token, info in list(file_registry.items()):
-            expires_at = info.get("expires_at")
-            if expires_at and now > expires_at:
-                expired_tokens.append(token)
-
-        for token in expired_tokens:
-            info = file_registry.pop(token, None)
-            if not info:
-                continue
-            try:
-                filepath = Path(info["filepath"])
-                if filepath.exists():
-                    filepath.unlink()
-                    logger.info(f"Arquivo expirado removido: {filepath.name}")
-            except Exception as e:
-                logger.error(f"Erro ao remover arquivo expirado: {e}")
+        while _expiry_heap and _expiry_heap[0][0] < now:
+            _, token = heapq.heappop(_expiry_heap)
+            info = _release_token_locked(token)
+            if info:
+                expired.append(info)
+
+    for info in expired:
+        try:
+            filepath = Path(info["filepath"])
+            if _unlink_if_unreferenced(filepath):
+                logger.info(f"Arquivo expirado removido: {filepath.name}")
+        except Exception as e:
+            logger.error(f"Erro ao remover arquivo expirado: {e}")
+
+
+_cleanup_thread: Optional[threading.Thread] = None
+_cleanup_thread_lock = threading.Lock()
+
+def _cleanup_loop() -> None:
+    while True:
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+        try:
+            cleanup_expired_files()
+        except Exception:
+            logger.exception("Erro no cleanup periódico")
+
+def start_cleanup_thread() -> None:
+    """Inicia (uma única vez) a thread daemon de cleanup, fora do caminho das requisições."""
+    global _cleanup_thread
+    with _cleanup_thread_lock:
+        if _cleanup_thread is not None:
+            return
+        _cleanup_thread = threading.Thread(target=_cleanup_loop, name="cronograma-cleanup", daemon=True)
+        _cleanup_thread.start()
 
 
 # ========================================================
 # VALIDATION (regras adicionais além do Pydantic)
 # ========================================================
 
-def validate_payload_dict(payload: dict) -> Tuple[bool, Optional[dict]]:
+def validate_payload_dict(payload: dict) -> Tuple[bool, Optional[dict], Optional[dict]]:
     """
-    Mantém validações "de negócio" extras + MAX_ROWS.
-    Observação: Pydantic já garante required + tipos + min_length + hours>0.
+    Mantém validações "de negócio" extras + MAX_ROWS + hours.
+    Observação: no HTTP o Pydantic já garante required + tipos + min_length + hours>0;
+    a checagem de hours aqui cobre o caminho MCP, que recebe dict cru.
+
+    Retorna (ok, erro, totais). Em caso de sucesso, totais traz
+    project_total_hours / macro_count / micro_count já somados durante a validação.
     """
     errors = []
 
     # MAX_ROWS
-    settings = payload.get("settings") if isinstance(payload.get("settings"), dict) else {}
+    settings = payload_settings(payload)
     try:
         max_rows_limit = int(settings.get("max_rows", MAX_ROWS))
     except Exception:
         max_rows_limit = MAX_ROWS
 
-    total_rows = 1  # projeto
-    macros = payload.get("macros", [])
-    for macro in macros:
-        total_rows += 1  # macro
-        micros = (macro or {}).get("micros", [])
-        total_rows += len(micros)
+    # Contagem estrutural barata antes de qualquer validação por campo:
+    # payload gigante é rejeitado sem montar mensagens de erro por item
+    macros = payload.get("macros") or []
+    total_rows = 1 + len(macros) + sum(  # projeto + macros + micros
+        len(macro.get("micros") or []) for macro in macros if isinstance(macro, dict)
+    )
 
     if total_rows > max_rows_limit:
         errors.append({
@@ -215,135 +487,482 @@ def validate_payload_dict(payload: dict) -> Tuple[bool, Optional[dict]]:
             "error_code": "MAX_ROWS_EXCEEDED",
             "message": f"O cronograma possui {total_rows} linhas, excedendo o limite de {max_rows_limit}",
             "details": errors,
-        }
+        }, None
+
+    # surrogate solto ("\ud800" num JSON) não é codificável em UTF-8: o XLSX até sai
+    # (a engine remove), mas a resposta ecoa estes nomes e a serialização falharia (500)
+    echoed = [("project.name", (payload.get("project") or {}).get("name"))]
+    echoed += [(f"macros[{i}].name", (m or {}).get("name")) for i, m in enumerate(macros)]
+    for field, value in echoed:
+        if isinstance(value, str) and not value.isascii() and _RE_SURROGATE.search(value):
+            errors.append({"field": field, "issue": "texto contém caractere Unicode inválido (surrogate solto)"})
+
+    # sheet_name: o HTTP já normaliza no SettingsModel; no MCP só o tipo é checado aqui
+    # (a normalização em si é feita na geração, pela mesma normalize_sheet_name)
+    sheet_name = settings.get("sheet_name")
+    if sheet_name is not None and not isinstance(sheet_name, str):
+        errors.append({
+            "field": "settings.sheet_name",
+            "issue": f"sheet_name deve ser texto (recebido: {sheet_name!r})",
+        })
 
-    return True, None
+    # hours: caminho rápido (map/min em C) por macro; diagnóstico por item só se falhar
+    project_total_hours = 0.0
+    micro_count = 0
+    for macro_idx, macro in enumerate(macros):
+        micros = (macro or {}).get("micros", [])
+        hours = [(micro or {}).get("hours") for micro in micros]
+        micro_count += len(hours)
+        try:
+            values = list(map(float, hours))
+            if min(values, default=1.0) > 0 and all(map(math.isfinite, values)):
+                project_total_hours += sum(values)
+                continue
+        except (TypeError, ValueError):
+            pass
+
+        for micro_idx, h in enumerate(hours):
+            try:
+                value = float(h)
+            except (TypeError, ValueError):
+                value = None
+            if value is None or not math.isfinite(value) or value <= 0:
+                errors.append({
+                    "field": f"macros[{macro_idx}].micros[{micro_idx}].hours",
+                    "issue": f"hours deve ser numérico e maior que 0 (recebido: {h!r})",
+                })
+
+    if errors:
+        return False, {
+            "ok": False,
+            "error_code": "VALIDATION_ERROR",
+            "message": "Erro de validação no payload",
+            "details": errors,
+        }, None
+
+    return True, None, {
+        "project_total_hours": project_total_hours,
+        "macro_count": len(macros),
+        "micro_count": micro_count,
+    }
 
 
 # ========================================================
-# XLSX GEN
+# XLSX STYLES (criados uma vez no import e reutilizados)
 # ========================================================
 
-def generate_xlsx(payload: dict) -> Tuple[Path, dict, float]:
-    project = payload["project"]
-    settings = payload.get("settings", {}) if isinstance(payload.get("settings", {}), dict) else {}
-    macros = payload["macros"]
+HEADER_FONT = Font(bold=True, size=11)
+HEADER_FILL = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
+CENTER_ALIGN = Alignment(horizontal="center", vertical="center")
+HEADER_ALIGN_CENTER = CENTER_ALIGN
+HEADER_ALIGN_LEFT = Alignment(horizontal="left", vertical="center")
 
-    sheet_name = settings.get("sheet_name", "Planilha1")
-    include_project_row = bool(settings.get("include_project_row", True))
+PROJECT_FONT = Font(bold=True, size=11)
+PROJECT_FILL = PatternFill(start_color="A9A9A9", end_color="A9A9A9", fill_type="solid")
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = sheet_name
+MACRO_FONT = Font(bold=True, size=10)
+MACRO_FILL = PatternFill(start_color="E8E8E8", end_color="E8E8E8", fill_type="solid")
 
-    # styles
-    header_font = Font(bold=True, size=11)
-    header_fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
+BORDER_THIN = Border(
+    left=Side(style="thin"),
+    right=Side(style="thin"),
+    top=Side(style="thin"),
+    bottom=Side(style="thin"),
+)
 
-    project_font = Font(bold=True, size=11)
-    project_fill = PatternFill(start_color="A9A9A9", end_color="A9A9A9", fill_type="solid")
+HEADER_VALUES = ("Nome da Tarefa", "Duration", "Responsável")
+
+# alinhamento por coluna (A, B, C): Duration sempre centralizada
+HEADER_ALIGNMENTS = (HEADER_ALIGN_LEFT, HEADER_ALIGN_CENTER, HEADER_ALIGN_CENTER)
+ROW_ALIGNMENTS = (None, CENTER_ALIGN, None)
+
+# tipo de linha -> (font, fill, alinhamentos) no openpyxl
+ROW_STYLES = {
+    "header": (HEADER_FONT, HEADER_FILL, HEADER_ALIGNMENTS),
+    "project": (PROJECT_FONT, PROJECT_FILL, ROW_ALIGNMENTS),
+    "macro": (MACRO_FONT, MACRO_FILL, ROW_ALIGNMENTS),
+    "micro": (None, None, ROW_ALIGNMENTS),
+}
+
+# Mesmo layout para o pyexcelerate: tipo de linha -> Style por coluna (A, B, C)
+if pyexcelerate is not None:
+    # instância única: o pyexcelerate indexa bordas por objeto ao salvar
+    PX_BORDERS_THIN = PxBorders(
+        left=PxBorder(style="thin"),
+        right=PxBorder(style="thin"),
+        top=PxBorder(style="thin"),
+        bottom=PxBorder(style="thin"),
+    )
+    PX_ALIGN_CENTER = pyexcelerate.Alignment(horizontal="center", vertical="center")
+    PX_ALIGN_LEFT = pyexcelerate.Alignment(horizontal="left", vertical="center")
+
+    def _px_row_styles(font=None, fill=None, header: bool = False) -> Tuple[Any, Any, Any]:
+        borders = PX_BORDERS_THIN
+        center = pyexcelerate.Style(font=font, fill=fill, borders=borders, alignment=PX_ALIGN_CENTER)
+        if header:
+            left = pyexcelerate.Style(font=font, fill=fill, borders=borders, alignment=PX_ALIGN_LEFT)
+            return left, center, center
+        plain = pyexcelerate.Style(font=font, fill=fill, borders=borders)
+        return plain, center, plain
+
+    PX_ROW_STYLES = {
+        "header": _px_row_styles(
+            pyexcelerate.Font(bold=True, size=11),
+            pyexcelerate.Fill(background=pyexcelerate.Color(0xD3, 0xD3, 0xD3)),
+            header=True,
+        ),
+        "project": _px_row_styles(
+            pyexcelerate.Font(bold=True, size=11),
+            pyexcelerate.Fill(background=pyexcelerate.Color(0xA9, 0xA9, 0xA9)),
+        ),
+        "macro": _px_row_styles(
+            pyexcelerate.Font(bold=True, size=10),
+            pyexcelerate.Fill(background=pyexcelerate.Color(0xE8, 0xE8, 0xE8)),
+        ),
+        "micro": _px_row_styles(),
+    }
+    PX_COLUMN_STYLES = (
+        pyexcelerate.Style(size=70),
+        pyexcelerate.Style(size=15),
+        pyexcelerate.Style(size=22),
+    )
 
-    macro_font = Font(bold=True, size=10)
-    macro_fill = PatternFill(start_color="E8E8E8", end_color="E8E8E8", fill_type="solid")
 
-    border_thin = Border(
-        left=Side(style="thin"),
-        right=Side(style="thin"),
-        top=Side(style="thin"),
-        bottom=Side(style="thin"),
+# Engine xml: mesmo layout escrito direto no zip (sem objeto por célula).
+# cellXfs: 0 padrão; 1/2 header (esq./centro); 3/4 projeto; 5/6 macro; 7/8 micro (normal/centro)
+XML_ROW_XFS = {
+    "header": (1, 2, 2),
+    "project": (3, 4, 3),
+    "macro": (5, 6, 5),
+    "micro": (7, 8, 7),
+}
+
+_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+XML_CONTENT_TYPES = (
+    _XML_DECL
+    + '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    "</Types>"
+)
+XML_ROOT_RELS = (
+    _XML_DECL
+    + f'<Relationships xmlns="{_NS_PKG_REL}">'
+    f'<Relationship Id="rId1" Type="{_NS_REL}/officeDocument" Target="xl/workbook.xml"/>'
+    "</Relationships>"
+)
+XML_WORKBOOK_RELS = (
+    _XML_DECL
+    + f'<Relationships xmlns="{_NS_PKG_REL}">'
+    f'<Relationship Id="rId1" Type="{_NS_REL}/worksheet" Target="worksheets/sheet1.xml"/>'
+    f'<Relationship Id="rId2" Type="{_NS_REL}/styles" Target="styles.xml"/>'
+    "</Relationships>"
+)
+
+def _xml_xf(font_id: int, fill_id: int, align: Optional[str]) -> str:
+    attrs = f'numFmtId="0" fontId="{font_id}" fillId="{fill_id}" borderId="1" applyBorder="1"'
+    if font_id:
+        attrs += ' applyFont="1"'
+    if fill_id:
+        attrs += ' applyFill="1"'
+    if align is None:
+        return f"<xf {attrs}/>"
+    return f'<xf {attrs} applyAlignment="1"><alignment horizontal="{align}" vertical="center"/></xf>'
+
+XML_STYLES = (
+    _XML_DECL
+    + f'<styleSheet xmlns="{_NS_MAIN}">'
+    '<fonts count="3">'
+    '<font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="10"/><name val="Calibri"/></font>'
+    "</fonts>"
+    '<fills count="5">'
+    '<fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill>'
+    + "".join(
+        f'<fill><patternFill patternType="solid"><fgColor rgb="00{rgb}"/><bgColor rgb="00{rgb}"/></patternFill></fill>'
+        for rgb in ("D3D3D3", "A9A9A9", "E8E8E8")
     )
+    + "</fills>"
+    '<borders count="2">'
+    "<border><left/><right/><top/><bottom/><diagonal/></border>"
+    '<border><left style="thin"/><right style="thin"/><top style="thin"/><bottom style="thin"/><diagonal/></border>'
+    "</borders>"
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="9">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    + _xml_xf(1, 2, "left") + _xml_xf(1, 2, "center")  # header
+    + _xml_xf(1, 3, None) + _xml_xf(1, 3, "center")    # projeto
+    + _xml_xf(2, 4, None) + _xml_xf(2, 4, "center")    # macro
+    + _xml_xf(0, 0, None) + _xml_xf(0, 0, "center")    # micro
+    + "</cellXfs>"
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    "</styleSheet>"
+)
+
+# mesmas larguras do openpyxl; header congelado (equivale a freeze_panes="A2")
+XML_SHEET_HEAD = (
+    _XML_DECL
+    + f'<worksheet xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}">'
+    '<sheetViews><sheetView workbookViewId="0">'
+    '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+    '<selection pane="bottomLeft" activeCell="A2" sqref="A2"/>'
+    "</sheetView></sheetViews>"
+    '<sheetFormatPr defaultRowHeight="15"/>'
+    "<cols>"
+    '<col min="1" max="1" width="70" customWidth="1"/>'
+    '<col min="2" max="2" width="15" customWidth="1"/>'
+    '<col min="3" max="3" width="22" customWidth="1"/>'
+    "</cols>"
+    "<sheetData>"
+)
+XML_SHEET_TAIL = "</sheetData></worksheet>"
+
+# caracteres de controle não são XML válido (o openpyxl recusa; aqui são descartados)
+# inválidos em XML 1.0: controles C0 (exceto \t \n \r), U+FFFE/U+FFFF e surrogates soltos.
+# Fonte única para a regex e para a checagem do atalho de _xml_text
+_XML_ILLEGAL_RANGES = ((0x00, 0x08), (0x0B, 0x0C), (0x0E, 0x1F), (0xFFFE, 0xFFFF), (0xD800, 0xDFFF))
+_RE_XML_ILLEGAL = re.compile(
+    "[" + "".join(f"\\u{lo:04x}-\\u{hi:04x}" for lo, hi in _XML_ILLEGAL_RANGES) + "]"
+)
+
 
+# ========================================================
+# XLSX GEN
+# ========================================================
+
+def _styled_cell(ws, value: Any, font: Optional[Font], fill: Optional[PatternFill], alignment: Optional[Alignment]) -> WriteOnlyCell:
+    cell = WriteOnlyCell(ws, value=value)
+    cell.border = BORDER_THIN
+    if font is not None:
+        cell.font = font
+    if fill is not None:
+        cell.fill = fill
+    if alignment is not None:
+        cell.alignment = alignment
+    return cell
+
+
+def _row_style_templates(ws) -> Dict[str, Tuple[StyleArray, StyleArray, StyleArray]]:
+    """
+    Resolve uma vez por workbook o StyleArray (índices de font/fill/border/alignment)
+    de cada coluna para cada tipo de linha. Atribuir font/fill/... célula a célula
+    re-hasheia o objeto de estilo a cada set; copiar o StyleArray pronto não.
+    """
+    templates = {}
+    for kind, (font, fill, alignments) in ROW_STYLES.items():
+        templates[kind] = tuple(
+            _styled_cell(ws, None, font, fill, alignment)._style for alignment in alignments
+        )
+    return templates
+
+
+def styled_row(
+    ws,
+    values: Tuple[Any, Any, Any],
+    styles: Tuple[StyleArray, StyleArray, StyleArray],
+) -> List[WriteOnlyCell]:
+    """Monta as 3 células (A, B, C) de uma linha copiando o estilo pré-resolvido, sem loop por coluna."""
+    a, b, c = values
+    style_a, style_b, style_c = styles
+    cell_a = WriteOnlyCell(ws, value=a)
+    cell_a._style = StyleArray(style_a)
+    cell_b = WriteOnlyCell(ws, value=b)
+    cell_b._style = StyleArray(style_b)
+    cell_c = WriteOnlyCell(ws, value=c)
+    cell_c._style = StyleArray(style_c)
+    return [cell_a, cell_b, cell_c]
+
+
+def _save_xlsx_openpyxl(rows: List[Tuple[str, Tuple[Any, Any, Any]]], sheet_name: str, target: Union[Path, BinaryIO]) -> None:
+    # write_only: as linhas são serializadas no append (sem manter Cells em memória)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+
+    # em write_only, dimensões e freeze_panes precisam vir antes do primeiro append
     ws.column_dimensions["A"].width = 70
     ws.column_dimensions["B"].width = 15
     ws.column_dimensions["C"].width = 22
+    ws.freeze_panes = "A2"
 
-    # header row
-    ws["A1"] = "Nome da Tarefa"
-    ws["B1"] = "Duration"
-    ws["C1"] = "Responsável"
+    templates = _row_style_templates(ws)
+    for kind, values in rows:
+        ws.append(styled_row(ws, values, templates[kind]))
 
-    for col in ["A", "B", "C"]:
-        cell = ws[f"{col}1"]
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.border = border_thin
-        cell.alignment = header_alignment if col != "A" else Alignment(horizontal="left", vertical="center")
+    wb.save(target)
 
-    ws.freeze_panes = "A2"
-    current_row = 2
 
-    # totals
+def _save_xlsx_pyexcelerate(rows: List[Tuple[str, Tuple[Any, Any, Any]]], sheet_name: str, target: Union[Path, BinaryIO]) -> None:
+    wb = pyexcelerate.Workbook()
+    # o template do pyexcelerate (workbook.xml/app.xml) não escapa o nome da aba: vai escapado.
+    # force_name: o limite de 31 já foi aplicado em normalize_sheet_name (antes do escape)
+    ws = wb.new_sheet(
+        xml_escape(sheet_name, {'"': "&quot;"}),
+        data=[values for _, values in rows],
+        force_name=True,
+    )
+
+    for col, style in enumerate(PX_COLUMN_STYLES, start=1):
+        ws.set_col_style(col, style)
+    ws.panes = pyexcelerate.Panes(y=1)  # congela o header (equivale a A2)
+
+    # pyexcelerate indexa linhas/colunas a partir de 1; Style é reaproveitado entre células
+    for row_idx, (kind, _) in enumerate(rows, start=1):
+        for col, style in enumerate(PX_ROW_STYLES[kind], start=1):
+            ws.set_cell_style(row_idx, col, style)
+
+    # pyexcelerate só reconhece caminho como str; file-like é usado direto
+    wb.save(str(target) if isinstance(target, Path) else target)
+
+
+# o atalho de _xml_text só é seguro se todo caractere removido pela regex for não-imprimível
+# (controles são Cc, U+FFFE/U+FFFF são Cn, surrogates são Cs). Conferido uma vez no import:
+# se _XML_ILLEGAL_RANGES ganhar algo imprimível, o atalho desliga e tudo passa pela regex
+_XML_SKIP_PRINTABLE = not any(
+    chr(c).isprintable() for lo, hi in _XML_ILLEGAL_RANGES for c in range(lo, hi + 1)
+)
+
+def _xml_text(text: str) -> str:
+    # isprintable() (C, sem regex) cobre o caso comum; controles, \t/\n, U+FFFE/U+FFFF
+    # e surrogates são não-imprimíveis e sempre passam pela regex
+    if not (_XML_SKIP_PRINTABLE and text.isprintable()):
+        text = _RE_XML_ILLEGAL.sub("", text)
+    return xml_escape(text)
+
+
+def _xml_cell(ref: str, xf: int, value: Any) -> str:
+    if value is None or value == "":
+        return f'<c r="{ref}" s="{xf}"/>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}" s="{xf}"><v>{value!r}</v></c>'
+    text = _xml_text(str(value))
+    return f'<c r="{ref}" s="{xf}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _save_xlsx_xml(rows: List[Tuple[str, Tuple[Any, Any, Any]]], sheet_name: str, target: Union[Path, BinaryIO]) -> None:
+    parts = [XML_SHEET_HEAD]
+    for row_num, (kind, values) in enumerate(rows, start=1):
+        xf_a, xf_b, xf_c = XML_ROW_XFS[kind]
+        a, b, c = values
+        parts.append(
+            f'<row r="{row_num}">'
+            + _xml_cell(f"A{row_num}", xf_a, a)
+            + _xml_cell(f"B{row_num}", xf_b, b)
+            + _xml_cell(f"C{row_num}", xf_c, c)
+            + "</row>"
+        )
+    parts.append(XML_SHEET_TAIL)
+
+    # escapar não basta: título que o Excel recusa ("Fase 1/2") gera arquivo ilegível.
+    # generate_xlsx já normaliza; repetir aqui (idempotente, memoizado) protege chamadas diretas
+    sheet_name_attr = xml_escape(normalize_sheet_name(sheet_name), {'"': "&quot;"})
+    workbook_xml = (
+        _XML_DECL
+        + f'<workbook xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}">'
+        f'<sheets><sheet name="{sheet_name_attr}" sheetId="1" r:id="rId1"/></sheets>'
+        "</workbook>"
+    )
+
+    with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", XML_CONTENT_TYPES)
+        zf.writestr("_rels/.rels", XML_ROOT_RELS)
+        zf.writestr("xl/workbook.xml", workbook_xml)
+        zf.writestr("xl/_rels/workbook.xml.rels", XML_WORKBOOK_RELS)
+        zf.writestr("xl/styles.xml", XML_STYLES)
+        zf.writestr("xl/worksheets/sheet1.xml", "".join(parts))
+
+
+def _save_xlsx(engine: str, rows: List[Tuple[str, Tuple[Any, Any, Any]]], sheet_name: str, target: Union[Path, BinaryIO]) -> None:
+    if engine == "pyexcelerate":
+        _save_xlsx_pyexcelerate(rows, sheet_name, target)
+    elif engine == "xml":
+        _save_xlsx_xml(rows, sheet_name, target)
+    else:
+        _save_xlsx_openpyxl(rows, sheet_name, target)
+
+
+def generate_xlsx(payload: dict, to_stream: bool = False) -> Tuple[Union[Path, io.BytesIO], dict, float]:
+    """
+    Gera o XLSX. Por padrão salva em OUTPUT_DIR e retorna o Path;
+    com to_stream=True salva num BytesIO (posicionado no início) e retorna o buffer.
+    """
+    project = payload["project"]
+    settings = payload_settings(payload)
+    macros = payload["macros"]
+
+    sheet_name = normalize_sheet_name(settings.get("sheet_name") or SHEET_NAME_DEFAULT)
+    include_project_row = bool(settings.get("include_project_row", True))
+
+    engine = str(settings.get("engine") or XLSX_ENGINE).strip().lower()
+    if engine == "pyexcelerate" and pyexcelerate is None:
+        logger.warning("pyexcelerate não instalado - usando openpyxl")
+        engine = "openpyxl"
+
+    # passada única: acumula totais e monta a planilha inteira como lista (tipo, valores),
+    # header incluso, para cada engine escrever tudo numa varredura só
     project_total_hours = 0.0
     macro_summaries = []
+    rows: List[Tuple[str, Tuple[Any, Any, Any]]] = [("header", HEADER_VALUES)]
 
     for macro in macros:
         macro_total_hours = 0.0
         micro_count = 0
+
+        # reserva a posição da macro; o total só é conhecido após as micros
+        macro_row_idx = len(rows)
+        rows.append(None)
+
         for micro in macro["micros"]:
             h = float(micro["hours"])
             macro_total_hours += h
             micro_count += 1
+            rows.append((
+                "micro",
+                (f"    {micro['name']}", hours_to_duration_display(h), micro.get("responsible", "")),  # texto
+            ))
+
+        macro_duration_display = hours_to_duration_display(macro_total_hours)
+        rows[macro_row_idx] = (
+            "macro",
+            (macro["name"], macro_duration_display, macro.get("responsible", "")),  # texto
+        )
 
         project_total_hours += macro_total_hours
         macro_summaries.append({
             "name": macro["name"],
             "hours": round(macro_total_hours, 4),
-            "duration_display": hours_to_duration_display(macro_total_hours),
+            "duration_display": macro_duration_display,
             "micro_count": micro_count,
         })
 
-    # project row
+    # project row (logo após o header)
     if include_project_row:
-        ws[f"A{current_row}"] = project["name"]
-        ws[f"B{current_row}"] = hours_to_duration_display(project_total_hours)  # texto
-        ws[f"C{current_row}"] = project.get("owner", "")
-
-        for col in ["A", "B", "C"]:
-            cell = ws[f"{col}{current_row}"]
-            cell.font = project_font
-            cell.fill = project_fill
-            cell.border = border_thin
-            if col == "B":
-                cell.alignment = Alignment(horizontal="center", vertical="center")
-        current_row += 1
-
-    # macros + micros
-    for macro_idx, macro in enumerate(macros):
-        ws[f"A{current_row}"] = macro["name"]
-        ws[f"B{current_row}"] = macro_summaries[macro_idx]["duration_display"]  # texto
-        ws[f"C{current_row}"] = macro.get("responsible", "")
-
-        for col in ["A", "B", "C"]:
-            cell = ws[f"{col}{current_row}"]
-            cell.font = macro_font
-            cell.fill = macro_fill
-            cell.border = border_thin
-            if col == "B":
-                cell.alignment = Alignment(horizontal="center", vertical="center")
-
-        current_row += 1
-
-        for micro in macro["micros"]:
-            hours = float(micro["hours"])
-            ws[f"A{current_row}"] = f"    {micro['name']}"
-            ws[f"B{current_row}"] = hours_to_duration_display(hours)  # texto
-            ws[f"C{current_row}"] = micro.get("responsible", "")
-
-            for col in ["A", "B", "C"]:
-                cell = ws[f"{col}{current_row}"]
-                cell.border = border_thin
-                if col == "B":
-                    cell.alignment = Alignment(horizontal="center", vertical="center")
-            current_row += 1
-
-    project_name_clean = sanitize_filename(project["name"])
-    timestamp = datetime.now().strftime("%Y-%m-%d")
-    filename = f"Cronograma_-_{project_name_clean}_-_{timestamp}.xlsx"
-    filepath = OUTPUT_DIR / filename
+        rows.insert(1, (
+            "project",
+            (project["name"], hours_to_duration_display(project_total_hours), project.get("owner", "")),  # texto
+        ))
+
+    if to_stream:
+        target = io.BytesIO()
+        _save_xlsx(engine, rows, sheet_name, target)
+    else:
+        target = xlsx_output_path(project["name"])
+        with atomic_output(target) as tmp_path:
+            _save_xlsx(engine, rows, sheet_name, tmp_path)
 
-    wb.save(filepath)
-    logger.info(f"XLSX gerado: {filepath.name}")
+    if to_stream:
+        target.seek(0)
+        logger.info(f"XLSX gerado em memória ({engine}): {target.getbuffer().nbytes} bytes")
+    else:
+        logger.info(f"XLSX gerado ({engine}): {target.name}")
 
     summary = {
         "macro_count": len(macros),
@@ -351,52 +970,122 @@ def generate_xlsx(payload: dict) -> Tuple[Path, dict, float]:
         "macros": macro_summaries,
     }
 
-    return filepath, summary, project_total_hours
+    return target, summary, project_total_hours
 
 
 # ========================================================
 # CORE SERVICE (compartilhado)
 # ========================================================
 
+def _payload_digest(payload: dict) -> Optional[str]:
+    """Hash do payload (chaves ordenadas): chave do cache e sufixo do arquivo em disco."""
+    try:
+        raw = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        return None  # payload MCP com tipo não serializável: segue sem cache
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _file_id(filepath: Path) -> Optional[Tuple[int, int, int]]:
+    """Identifica o conteúdo em disco: muda se o arquivo for regravado (ex.: outro payload, mesmo nome)."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
 def build_generation_response(payload: dict) -> dict:
     logger.info("Iniciando geração de cronograma XLSX")
 
-    cleanup_expired_files()
-
     # validação extra (MAX_ROWS, etc.)
-    ok, err = validate_payload_dict(payload)
+    ok, err, _ = validate_payload_dict(payload)
     if not ok:
         logger.warning(f"Validação falhou: {err['error_code']}")
         return err
 
-    filepath, summary, project_total_hours = generate_xlsx(payload)
-
-    with open(filepath, "rb") as f:
-        file_base64 = base64.b64encode(f.read()).decode("utf-8")
-
-    token = generate_token()
-    expires_at = datetime.now() + timedelta(minutes=TTL_MINUTES)
+    project = payload["project"]
+    settings = payload_settings(payload)
+    include_base64 = bool(settings.get("include_base64", False))
+    format_version = settings.get("format_version", "1.0.0")
+
+    # Cache de resultado: retry/repetição do mesmo payload reaproveita o arquivo.
+    # Só vale enquanto o arquivo tem token vivo (senão o cleanup já pode tê-lo removido)
+    # e não foi regravado por outro payload com o mesmo nome.
+    # A data do dia entra na chave porque entra no nome do arquivo.
+    digest = _payload_digest(payload)
+    cache_key = f"{datetime.now():%Y-%m-%d}:{digest}" if digest and RESULT_CACHE_SIZE > 0 else None
+    cached = None
+    entry = None
+    if cache_key:
+        with registry_lock:
+            entry = _result_cache.get(cache_key)
+            if entry and not _file_refs.get(entry["filepath"]):
+                entry = None
+    # stat fora do lock; depois re-checa sob o lock que a entrada continua a mesma e com
+    # token vivo (entrada trocada = arquivo regravado; sem token = o cleanup pode tê-lo removido)
+    if entry and _file_id(Path(entry["filepath"])) == entry["file_id"]:
+        with registry_lock:
+            if _result_cache.get(cache_key) is entry and _file_refs.get(entry["filepath"]):
+                _result_cache.move_to_end(cache_key)
+                filepath = Path(entry["filepath"])
+                filename = entry["filename"]
+                token, expires_at = _register_token_locked(filepath, filename)
+                cached = entry
+
+    # base64 é opt-in: evita inflar a resposta em ~33%.
+    # O XLSX é gerado em memória: o base64 (se pedido) sai do buffer e o disco recebe
+    # uma única escrita (para o download_url), sem reler o arquivo. A identidade do
+    # arquivo vem dessa mesma escrita (write_atomic), não de um stat posterior.
+    file_base64 = None
+    if cached:
+        logger.info(f"Cronograma reaproveitado do cache: {filepath.name}")
+        summary, project_total_hours = cached["summary"], cached["project_total_hours"]
+        if include_base64:
+            file_base64 = base64.b64encode(filepath.read_bytes()).decode("ascii")
+    else:
+        buf, summary, project_total_hours = generate_xlsx(payload, to_stream=True)
+        data = buf.getbuffer()
+        if include_base64:
+            file_base64 = base64.b64encode(data).decode("ascii")
+        # sem digest (payload não serializável), um sufixo aleatório mantém o caminho exclusivo
+        filepath = xlsx_output_path(project["name"], digest or os.urandom(8).hex())
+        filename = xlsx_download_name(project["name"])
+        # reserva antes de escrever: o cleanup de um token antigo deste mesmo caminho
+        # não pode apagar o arquivo entre a escrita e o registro do token novo
+        with registry_lock:
+            _reserve_path_locked(filepath)
+        try:
+            file_id = write_atomic(filepath, data)
+        except BaseException:
+            with registry_lock:
+                _unreserve_path_locked(filepath)
+            raise
 
-    with registry_lock:
-        file_registry[token] = {
-            "filepath": str(filepath),
-            "filename": filepath.name,
-            "expires_at": expires_at,
-        }
+        with registry_lock:
+            _unreserve_path_locked(filepath)
+            token, expires_at = _register_token_locked(filepath, filename)
+            if cache_key:
+                _result_cache[cache_key] = {
+                    "filepath": str(filepath),
+                    "filename": filename,
+                    "file_id": file_id,
+                    "summary": summary,
+                    "project_total_hours": project_total_hours,
+                }
+                _result_cache.move_to_end(cache_key)
+                while len(_result_cache) > RESULT_CACHE_SIZE:
+                    _result_cache.popitem(last=False)
 
     download_url = f"{BASE_URL}/download/{token}"
 
-    project = payload["project"]
-    settings = payload.get("settings", {}) if isinstance(payload.get("settings", {}), dict) else {}
-
     resp = {
         "ok": True,
-        "format_version": settings.get("format_version", "1.0.0"),
+        "format_version": format_version,
         "project_name": project["name"],
         "project_total_hours": round(project_total_hours, 4),
         "project_total_duration_display": hours_to_duration_display(project_total_hours),
-        "filename": filepath.name,
-        "mime_type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "filename": filename,
+        "mime_type": XLSX_MEDIA_TYPE,
         "base64": file_base64,
         "download_url": download_url,
         "download_expires_at": expires_at.isoformat(),
@@ -408,21 +1097,66 @@ def build_generation_response(payload: dict) -> dict:
     return resp
 
 
+async def build_batch_generation_response(payloads: List[dict], item_errors: Optional[Dict[int, dict]] = None) -> dict:
+    """
+    Gera vários cronogramas numa única chamada (um round trip para o agente).
+    Cada item roda em thread própria, concorrente com os demais; falha de um item
+    vira erro no próprio resultado, sem derrubar o lote.
+    item_errors: erros de schema já apurados por índice (HTTP), devolvidos no lugar do item.
+    """
+    if not isinstance(payloads, list) or not payloads:
+        return {
+            "ok": False,
+            "error_code": "VALIDATION_ERROR",
+            "message": "payloads deve ser uma lista com ao menos 1 cronograma",
+            "details": [{"field": "payloads", "issue": "lista vazia ou ausente"}],
+        }
+    if len(payloads) > MAX_BATCH:
+        return {
+            "ok": False,
+            "error_code": "BATCH_TOO_LARGE",
+            "message": f"O lote possui {len(payloads)} cronogramas, excedendo o limite de {MAX_BATCH}",
+            "details": [{"field": "payloads", "issue": f"máximo de {MAX_BATCH} por chamada"}],
+        }
+
+    async def _one(idx: int, payload: Any) -> dict:
+        if item_errors and idx in item_errors:
+            return item_errors[idx]
+        if not isinstance(payload, dict):
+            return {
+                "ok": False,
+                "error_code": "VALIDATION_ERROR",
+                "message": "Cada item do lote deve ser um objeto de payload",
+                "details": [{"field": f"payloads[{idx}]", "issue": "não é um objeto"}],
+            }
+        try:
+            return await asyncio.to_thread(build_generation_response, payload)
+        except Exception as e:
+            logger.error(f"Erro ao gerar item {idx} do lote: {e}", exc_info=True)
+            return {
+                "ok": False,
+                "error_code": "GENERATION_ERROR",
+                "message": f"Falha ao gerar o cronograma: {e}",
+                "details": [{"field": f"payloads[{idx}]", "issue": str(e)}],
+            }
+
+    results = await asyncio.gather(*(_one(i, p) for i, p in enumerate(payloads)))
+    return {
+        "ok": all(r.get("ok") for r in results),
+        "count": len(results),
+        "results": list(results),
+    }
+
+
 def build_validate_response(payload: dict) -> dict:
     logger.info("Validando payload (sem gerar arquivo)")
 
-    ok, err = validate_payload_dict(payload)
+    ok, err, totals = validate_payload_dict(payload)
     if not ok:
         return err
 
-    project_total_hours = 0.0
-    macro_count = len(payload["macros"])
-    micro_count = 0
-
-    for macro in payload["macros"]:
-        for micro in macro["micros"]:
-            project_total_hours += float(micro["hours"])
-            micro_count += 1
+    # totais já somados na validação (sem segunda passada pelas micros)
+    project_total_hours = totals["project_total_hours"]
 
     return {
         "ok": True,
@@ -431,8 +1165,8 @@ def build_validate_response(payload: dict) -> dict:
             "project_name": payload["project"]["name"],
             "project_total_hours": round(project_total_hours, 4),
             "project_total_duration_display": hours_to_duration_display(project_total_hours),
-            "macro_count": macro_count,
-            "micro_count": micro_count,
+            "macro_count": totals["macro_count"],
+            "micro_count": totals["micro_count"],
         },
     }
 
@@ -443,13 +1177,29 @@ def build_validate_response(payload: dict) -> dict:
 
 mcp = FastMCP("cronograma-mcp")
 
+# Tools async: o trabalho síncrono (openpyxl/pyexcelerate + base64) roda em thread,
+# liberando o event loop para outras chamadas MCP enquanto o XLSX é serializado.
+
 @mcp.tool()
-def gerar_xlsx(payload: dict) -> dict:
-    return build_generation_response(payload)
+async def gerar_xlsx(payload: dict) -> dict:
+    """
+    Gera o cronograma XLSX e retorna download_url + metadados.
+    O conteúdo em base64 só é incluído com settings.include_base64=true
+    (caso contrário, o campo "base64" vem como null).
+    """
+    return await asyncio.to_thread(build_generation_response, payload)
 
 @mcp.tool()
-def validar(payload: dict) -> dict:
-    return build_validate_response(payload)
+async def gerar_xlsx_lote(payloads: list) -> dict:
+    """
+    Gera vários cronogramas numa única chamada (até CRONOGRAMA_MAX_BATCH).
+    Retorna results na mesma ordem de payloads, cada um no formato de gerar_xlsx.
+    """
+    return await build_batch_generation_response(payloads)
+
+@mcp.tool()
+async def validar(payload: dict) -> dict:
+    return await asyncio.to_thread(build_validate_response, payload)
 
 @mcp.tool()
 def health() -> dict:
@@ -471,7 +1221,36 @@ def health() -> dict:
 # HTTP (produção)
 # ========================================================
 
-app = FastAPI(title="Cronograma Server (HTTP-first)")
+class JSONGZipMiddleware:
+    """
+    GZip só nas rotas JSON (/cronograma/*), onde o base64 inline comprime bem.
+    O /download fica de fora: o XLSX já é um zip e recomprimir só gasta CPU.
+    """
+
+    def __init__(self, app, minimum_size: int = 4096, compresslevel: int = 5):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/cronograma/"):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+# ORJSONResponse: serialização em C (orjson), relevante quando a resposta carrega base64
+app = FastAPI(title="Cronograma Server (HTTP-first)", default_response_class=ORJSONResponse)
+app.add_middleware(JSONGZipMiddleware, minimum_size=4096, compresslevel=5)
+
+@app.exception_handler(RequestValidationError)
+async def http_validation_error(request: Request, exc: RequestValidationError):
+    try:
+        return await request_validation_exception_handler(request, exc)
+    except UnicodeEncodeError:
+        # o 422 padrão ecoa o input; com surrogate solto ("\ud800") ele não é codificável
+        # em UTF-8 e viraria 500. Mesmo 422, sem o input
+        errors = [{k: v for k, v in err.items() if k != "input"} for err in exc.errors()]
+        return ORJSONResponse(status_code=422, content={"detail": jsonable_encoder(errors)})
 
 @app.get("/health")
 async def http_health():
@@ -493,54 +1272,104 @@ async def http_generate(payload: PayloadModel):
     - hours > 0
     """
     payload_dict = payload.model_dump(exclude_none=True)
-    resp = build_generation_response(payload_dict)
+    # wb.save / base64 / escrita em disco são síncronos: roda fora do event loop
+    resp = await asyncio.to_thread(build_generation_response, payload_dict)
     status = 200 if resp.get("ok") else 400
-    return JSONResponse(status_code=status, content=resp)
+    return ORJSONResponse(status_code=status, content=resp)
+
+def _validate_batch_items(items: List[Any]) -> Tuple[List[Optional[dict]], Dict[int, dict]]:
+    """Valida cada item contra PayloadModel; inválidos viram VALIDATION_ERROR no próprio índice."""
+    payload_dicts: List[Optional[dict]] = []
+    item_errors: Dict[int, dict] = {}
+    for idx, item in enumerate(items):
+        try:
+            payload_dicts.append(PayloadModel.model_validate(item).model_dump(exclude_none=True))
+        except ValidationError as e:
+            payload_dicts.append(None)
+            item_errors[idx] = {
+                "ok": False,
+                "error_code": "VALIDATION_ERROR",
+                "message": "Erro de validação no payload",
+                "details": [
+                    {"field": ".".join([f"payloads[{idx}]", *(str(p) for p in err["loc"])]), "issue": err["msg"]}
+                    for err in e.errors()
+                ],
+            }
+    return payload_dicts, item_errors
+
+@app.post("/cronograma/generate/batch")
+async def http_generate_batch(batch: BatchPayloadModel):
+    # lote acima do limite é recusado em build_batch_generation_response, sem validar item a item
+    if len(batch.payloads) > MAX_BATCH:
+        resp = await build_batch_generation_response(batch.payloads)
+    else:
+        payload_dicts, item_errors = _validate_batch_items(batch.payloads)
+        resp = await build_batch_generation_response(payload_dicts, item_errors)
+    # lote processado = 200 mesmo com falhas parciais: os itens ok já têm arquivo e token vivos,
+    # e cada resultado traz seu próprio "ok". 400 só quando o lote inteiro foi recusado
+    status = 200 if "results" in resp else 400
+    return ORJSONResponse(status_code=status, content=resp)
 
 @app.post("/cronograma/validate")
 async def http_validate(payload: PayloadModel):
     payload_dict = payload.model_dump(exclude_none=True)
-    resp = build_validate_response(payload_dict)
+    resp = await asyncio.to_thread(build_validate_response, payload_dict)
     status = 200 if resp.get("ok") else 400
-    return JSONResponse(status_code=status, content=resp)
+    return ORJSONResponse(status_code=status, content=resp)
 
 @app.get("/download/{token}")
 async def download_file(token: str):
-    cleanup_expired_files()
-
-    with registry_lock:
-        info = file_registry.get(token)
+    # leitura sem lock: dict.get de uma chave é atômico no CPython (o lock fica para escritas)
+    info = file_registry.get(token)
 
     if not info:
         raise HTTPException(status_code=404, detail="Arquivo não encontrado ou expirado")
 
+    # o cleanup roda em background: token vencido ainda pode estar no registry.
+    # Remove só este token (O(1)); se era o último do arquivo, o arquivo sai junto
+    if datetime.now() > info["expires_at"]:
+        with registry_lock:
+            released = _release_token_locked(token)
+        if released:
+            try:
+                _unlink_if_unreferenced(Path(released["filepath"]))
+            except OSError as e:
+                logger.error(f"Erro ao remover arquivo expirado: {e}")
+        raise HTTPException(status_code=404, detail="Arquivo não encontrado ou expirado")
+
     filepath = Path(info["filepath"])
-    if not filepath.exists():
+    # o stat serve de checagem de existência e é repassado ao FileResponse (evita um 2º stat)
+    try:
+        stat_result = os.stat(filepath)
+    except FileNotFoundError:
         with registry_lock:
-            file_registry.pop(token, None)
-        raise HTTP는Exception(status_code=404, detail="Arquivo não encontrado")
+            _release_token_locked(token)
+        raise HTTPException(status_code=404, detail="Arquivo não encontrado")
 
     logger.info(f"Download iniciado: {info['filename']}")
+    if USE_XACCEL:
+        # corpo vazio: o nginx entrega o arquivo (location interna apontando para OUTPUT_DIR)
+        return Response(
+            status_code=200,
+            media_type=XLSX_MEDIA_TYPE,
+            headers={
+                "X-Accel-Redirect": XACCEL_PREFIX + quote(filepath.name),
+                "Content-Disposition": f'attachment; filename="{info["filename"]}"',
+            },
+        )
+
+    # Content-Disposition é montado pelo Starlette a partir de filename (inclui filename*=UTF-8'' se preciso)
     return FileResponse(
         path=str(filepath),
         filename=info["filename"],
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f'attachment; filename="{info["filename"]}"'},
+        media_type=XLSX_MEDIA_TYPE,
+        stat_result=stat_result,
     )
 
 @app.on_event("startup")
 async def on_startup():
-    logger.info("HTTP server startup - iniciando tarefa de cleanup periódico")
-
-    async def _periodic_cleanup():
-        while True:
-            try:
-                cleanup_expired_files()
-            except Exception as e:
-                logger.error(f"Erro no cleanup periódico: {e}")
-            await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
-
-    asyncio.create_task(_periodic_cleanup())
+    logger.info("HTTP server startup - iniciando thread de cleanup periódico")
+    start_cleanup_thread()
 
 
 # ========================================================
@@ -553,6 +1382,13 @@ async def run_mcp_stdio():
     Observação: versões do fastmcp diferem. Vamos tentar o modo mais compatível.
     """
     logger.info("MCP stdio iniciado")
+    start_cleanup_thread()
+
+    # Caminho 0 (FastMCP do SDK oficial): versão async, roda no loop atual.
+    # mcp.run() é síncrono (abre o próprio loop) e falha dentro de asyncio.run
+    if hasattr(mcp, "run_stdio_async"):
+        await mcp.run_stdio_async()
+        return
 
     # Caminho 1 (comum em FastMCP): mcp.run(transport="stdio")
     try:
@@ -575,7 +1411,27 @@ async def run_mcp_stdio():
 
 def run_http():
     logger.info(f"Iniciando HTTP na porta {HTTP_PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=HTTP_PORT, log_level="info")
+    # loop/http ficam em "auto": com uvicorn[standard] já usam uvloop/httptools,
+    # e sem eles (ex.: Windows) caem em asyncio/h11 em vez de falhar
+    uvicorn.run(app, host="0.0.0.0", port=HTTP_PORT, log_level="info", access_log=ACCESS_LOG)
+
+async def run_dual():
+    """
+    stdio + HTTP no mesmo processo: o cliente MCP local fala por stdio (sem socket)
+    e o /download (e chamadas remotas) continuam no HTTP.
+    stdout é o canal MCP: o access log do uvicorn (que escreve em stdout) fica desligado.
+    """
+    logger.info(f"Iniciando HTTP na porta {HTTP_PORT} (junto com MCP stdio)")
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="0.0.0.0", port=HTTP_PORT, log_level="info", access_log=False)
+    )
+    http_task = asyncio.create_task(server.serve())
+    try:
+        await run_mcp_stdio()
+    finally:
+        # cliente MCP encerrou o stdio: derruba o HTTP junto
+        server.should_exit = True
+        await http_task
 
 if __name__ == "__main__":
     logger.info("=" * 60)
@@ -587,11 +1443,14 @@ if __name__ == "__main__":
     logger.info(f"TTL_MINUTES: {TTL_MINUTES}")
     logger.info(f"BASE_URL: {BASE_URL}")
     logger.info(f"HTTP_PORT: {HTTP_PORT}")
+    logger.info(f"XLSX_ENGINE: {XLSX_ENGINE}")
+    logger.info(f"USE_XACCEL: {USE_XACCEL} ({XACCEL_PREFIX})")
+    logger.info(f"LXML: {openpyxl.xml.LXML}")
     logger.info("=" * 60)
 
-    if RUN_MODE == "stdio":
+    if RUN_MODE in ("stdio", "dual", "both"):
         try:
-            asyncio.run(run_mcp_stdio())
+            asyncio.run(run_mcp_stdio() if RUN_MODE == "stdio" else run_dual())
         except KeyboardInterrupt:
             logger.info("Encerrado pelo usuário")
         except Exception:
@@ -12,12 +12,17 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 # Importar funções do main
 from main import (
-    validate_payload,
+    validate_payload_dict,
     hours_to_duration_display,
     generate_xlsx,
     sanitize_filename
 )
 
+def validate_payload(payload):
+    """(ok, erro) de validate_payload_dict, que também retorna os totais"""
+    ok, error, _ = validate_payload_dict(payload)
+    return ok, error
+
 def test_hours_to_duration():
     """Testa conversão de horas para formato HHH:MM:SS"""
     print("=" * 60)
@@ -247,6 +252,249 @@ def test_calculations():
         print(f"✗ Erro ao calcular: {e}")
         return False
 
+def test_sheet_names():
+    """Testa títulos de aba problemáticos em cada engine (ida e volta pelo openpyxl)"""
+    print("\n" + "=" * 60)
+    print("TESTE 6: Títulos de aba por engine")
+    print("=" * 60)
+
+    import io
+    import zipfile
+    import xml.etree.ElementTree as ET
+    from openpyxl import load_workbook
+
+    long_name = "Cronograma do Projeto de Migração 2024"  # 38 caracteres
+    test_cases = [
+        ("R&D", "R&D"),
+        ('Fase "A" <B>', 'Fase "A" <B>'),
+        ("Fase 1/2", "Fase 12"),
+        ("[Q1]: a*b?c\\d", "Q1 abcd"),
+        (long_name, long_name[:31]),
+        ("'Aspas'", "Aspas"),
+        ("///", "Planilha1"),
+        ("A\ufffeB\uffff", "AB"),
+        ("A\ud800B", "AB"),
+    ]
+    engines = ["pyexcelerate", "openpyxl", "xml"]
+
+    passed = 0
+    failed = 0
+
+    for engine in engines:
+        for sheet_name, expected in test_cases:
+            payload = {
+                "project": {"name": "Teste Abas"},
+                "macros": [{"name": "Macro 1", "micros": [{"name": "Micro 1", "hours": 1}]}],
+                "settings": {"sheet_name": sheet_name, "engine": engine},
+            }
+            try:
+                buf, _, _ = generate_xlsx(payload, to_stream=True)
+                data = buf.getvalue()
+                # todas as partes XML precisam ser bem formadas (não só as que o openpyxl lê)
+                with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                    for part in zf.namelist():
+                        if part.endswith(".xml") or part.endswith(".rels"):
+                            ET.fromstring(zf.read(part))
+                title = load_workbook(io.BytesIO(data)).sheetnames[0]
+                ok = title == expected
+                result = title
+            except Exception as e:
+                ok = False
+                result = f"erro: {e}"
+            if ok:
+                passed += 1
+            else:
+                failed += 1
+            print(f"{'✓' if ok else '✗'} [{engine}] {sheet_name!r} -> {result!r} (esperado: {expected!r})")
+
+    # engine xml: inválidos em XML 1.0 também saem do texto das células
+    for project_name in ("Projeto\ufffe", "Projeto\uffff", "Projeto\ud800"):
+        payload = {
+            "project": {"name": project_name},
+            "macros": [{"name": "Macro 1", "micros": [{"name": "Micro 1", "hours": 1}]}],
+            "settings": {"engine": "xml"},
+        }
+        try:
+            buf, _, _ = generate_xlsx(payload, to_stream=True)
+            result = load_workbook(buf).active["A2"].value
+            ok = result == "Projeto"
+        except Exception as e:
+            ok = False
+            result = f"erro: {e}"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+        print(f"{'✓' if ok else '✗'} [xml] projeto {project_name!r} -> {result!r} (esperado: 'Projeto')")
+
+    # _xml_text: o atalho isprintable() não pode pular a limpeza desses caracteres
+    import main
+    for text in ("a\ufffe", "a\uffff", "a\ud800", "a\x01"):
+        ok = main._xml_text(text) == "a"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+        print(f"{'✓' if ok else '✗'} _xml_text({text!r}) -> {main._xml_text(text)!r}")
+
+    # caminho MCP: nome ecoado na resposta com surrogate solto vira VALIDATION_ERROR (e não 500)
+    is_valid, error = validate_payload({
+        "project": {"name": "Projeto\ud800"},
+        "macros": [{"name": "Macro 1", "micros": [{"name": "Micro 1", "hours": 1}]}],
+    })
+    ok = not is_valid and error["details"][0]["field"] == "project.name"
+    if ok:
+        passed += 1
+    else:
+        failed += 1
+    print(f"{'✓' if ok else '✗'} surrogate solto em project.name rejeitado na validação")
+
+    print(f"\nResultado: {passed} passou, {failed} falhou")
+    return failed == 0
+
+def test_result_cache():
+    """Testa cache de resultado e refcount de tokens com o mesmo nome de projeto"""
+    print("\n" + "=" * 60)
+    print("TESTE 7: Cache de resultado e refcount de tokens")
+    print("=" * 60)
+
+    import os
+    import shutil
+    import main
+    from openpyxl import load_workbook
+
+    def payload(hours):
+        return {
+            "project": {"name": "Teste Cache"},
+            "macros": [{"name": "Macro 1", "micros": [{"name": "Micro 1", "hours": hours}]}],
+        }
+
+    def token_of(resp):
+        return resp["download_url"].rsplit("/", 1)[1]
+
+    def path_of(resp):
+        return main.file_registry[token_of(resp)]["filepath"]
+
+    def served_total(resp):
+        # B2 = duração da linha do projeto no arquivo que o download entregaria
+        return load_workbook(path_of(resp)).active["B2"].value
+
+    r1 = main.build_generation_response(payload(1))
+    r2 = main.build_generation_response(payload(2))
+    r1_hit = main.build_generation_response(payload(1))
+
+    # arquivo de outro conteúdo publicado por cima do de r1: o cache não pode mais servi-lo
+    stray = path_of(r1) + ".stray"
+    shutil.copyfile(path_of(r2), stray)
+    os.replace(stray, path_of(r1))
+    r1_regen = main.build_generation_response(payload(1))
+
+    # identidade devolvida pela própria escrita
+    probe = main.OUTPUT_DIR / "probe_write_atomic.xlsx"
+    probe_id = main.write_atomic(probe, b"conteudo")
+    st = os.stat(probe)
+    probe.unlink()
+
+    paths = {name: path_of(r) for name, r in (("r1", r1), ("r2", r2), ("r1_hit", r1_hit))}
+    totals = {"r2": served_total(r2), "r1_regen": served_total(r1_regen)}
+
+    # refcount: o arquivo só sai quando o último token dele é liberado
+    with main.registry_lock:
+        released = [main._release_token_locked(token_of(r)) for r in (r1, r1_hit, r1_regen)]
+
+    # interleaving do cleanup: fase 1 liberou o último token (acima); antes da fase 2
+    # o mesmo payload é regerado no mesmo caminho e ganha token novo (T2)
+    r1_t2 = main.build_generation_response(payload(1))
+    t2_path = path_of(r1_t2)
+    phase2_removed = main._unlink_if_unreferenced(Path(released[2]["filepath"]))
+    t2_alive = os.path.exists(t2_path)
+
+    # geração em andamento (reservada, ainda sem token) também segura o arquivo
+    with main.registry_lock:
+        main._reserve_path_locked(Path(t2_path))
+        main._release_token_locked(token_of(r1_t2))
+    pending_removed = main._unlink_if_unreferenced(Path(t2_path))
+    with main.registry_lock:
+        main._unreserve_path_locked(Path(t2_path))
+    free_removed = main._unlink_if_unreferenced(Path(t2_path))
+
+    checks = [
+        (paths["r1"] != paths["r2"], "Payloads diferentes não dividem arquivo"),
+        (r1["filename"] == r2["filename"], "Nome exibido no download não muda"),
+        (totals["r2"] == "2:00:00", "Download do payload 2 traz 2:00:00"),
+        (paths["r1_hit"] == paths["r1"], "Repetição do payload 1 reaproveita o arquivo"),
+        (totals["r1_regen"] == "1:00:00", "Arquivo regravado por fora é regerado"),
+        (probe_id == (st.st_ino, st.st_mtime_ns, st.st_size), "write_atomic retorna a identidade escrita"),
+        (released[0] is None and released[1] is None, "Tokens restantes seguram o arquivo"),
+        (released[2] is not None, "Último token libera o arquivo"),
+        (t2_path == paths["r1"], "Regeração reusa o mesmo caminho"),
+        (not phase2_removed and t2_alive, "Fase 2 do cleanup não apaga arquivo com token novo"),
+        (not pending_removed, "Geração em andamento segura o arquivo"),
+        (free_removed and not os.path.exists(t2_path), "Sem token nem reserva, o arquivo sai"),
+    ]
+
+    all_passed = True
+    for passed, name in checks:
+        print(f"{'✓' if passed else '✗'} {name}")
+        if not passed:
+            all_passed = False
+
+    return all_passed
+
+def test_batch():
+    """Testa lote com o mesmo nome de projeto e item inválido no meio"""
+    print("\n" + "=" * 60)
+    print("TESTE 8: Geração em lote")
+    print("=" * 60)
+
+    import asyncio
+    import orjson
+    import main
+    from openpyxl import load_workbook
+
+    def payload(hours):
+        return {
+            "project": {"name": "Projeto X"},
+            "macros": [{"name": "Macro 1", "micros": [{"name": "Micro 1", "hours": hours}]}],
+        }
+
+    def served_total(item):
+        token = item["download_url"].rsplit("/", 1)[1]
+        return load_workbook(main.file_registry[token]["filepath"]).active["B2"].value
+
+    # mesmo nome de projeto no mesmo dia: cada link precisa servir o próprio cronograma
+    resp = asyncio.run(main.build_batch_generation_response([payload(1), payload(2), payload(3)]))
+    served = [served_total(item) for item in resp["results"]]
+
+    # HTTP: item inválido (hours <= 0) vira erro só no próprio índice, com 200 para o lote
+    invalid = payload(1)
+    invalid["macros"][0]["micros"][0]["hours"] = 0
+    # item que nem é objeto também vira erro no próprio índice (e não 422 do lote)
+    http_resp = asyncio.run(main.http_generate_batch(main.BatchPayloadModel(payloads=[payload(4), invalid, 5])))
+    body = orjson.loads(http_resp.body)
+    results = body["results"]
+
+    # OpenAPI: cada item do lote continua descrito como PayloadModel
+    items_schema = main.app.openapi()["components"]["schemas"]["BatchPayloadModel"]["properties"]["payloads"]["items"]
+
+    checks = [
+        (served == ["1:00:00", "2:00:00", "3:00:00"], f"Cada link serve o próprio total ({served})"),
+        (http_resp.status_code == 200, f"Falha parcial responde 200 (recebido: {http_resp.status_code})"),
+        (results[0]["ok"] and served_total(results[0]) == "4:00:00", "Item válido gerado"),
+        (not results[1]["ok"] and results[1]["error_code"] == "VALIDATION_ERROR", "Item inválido vira erro no próprio resultado"),
+        (not results[2]["ok"] and results[2]["details"][0]["field"] == "payloads[2]", "Item não-objeto vira erro no próprio índice"),
+        (items_schema == {"$ref": "#/components/schemas/PayloadModel"}, "Schema dos itens referencia PayloadModel"),
+        (not body["ok"], "ok do lote reflete a falha parcial"),
+    ]
+
+    all_passed = True
+    for passed, name in checks:
+        print(f"{'✓' if passed else '✗'} {name}")
+        if not passed:
+            all_passed = False
+
+    return all_passed
+
 def main():
     """Executa todos os testes"""
     print("\n" + "=" * 60)
@@ -259,6 +507,9 @@ def main():
         ("Validação de payload", test_validation),
         ("Geração de XLSX", test_generate_xlsx),
         ("Cálculos de totais", test_calculations),
+        ("Títulos de aba", test_sheet_names),
+        ("Cache de resultado", test_result_cache),
+        ("Geração em lote", test_batch),
     ]
     
     results = []
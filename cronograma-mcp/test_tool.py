@@ -3,6 +3,7 @@
 Script para testar a tool gerar_xlsx via linha de comando
 """
 
+import asyncio
 import json
 import sys
 from pathlib import Path
@@ -37,7 +38,7 @@ def main():
     print(f"\n🔧 Chamando tool gerar_xlsx...")
     
     try:
-        result = gerar_xlsx(payload)
+        result = asyncio.run(gerar_xlsx(payload))
         
         if result["ok"]:
             print(f"\n✅ Sucesso!")
@@ -57,9 +58,12 @@ def main():
             for macro in result['summary']['macros']:
                 print(f"  - {macro['name']}: {macro['duration_display']} ({macro['micro_count']} micros)")
             
-            # Informação sobre base64
-            base64_size = len(result['base64'])
-            print(f"\n💾 Base64 gerado: {base64_size} caracteres")
+            # Informação sobre base64 (opt-in via settings.include_base64)
+            if result['base64'] is not None:
+                base64_size = len(result['base64'])
+                print(f"\n💾 Base64 gerado: {base64_size} caracteres")
+            else:
+                print(f"\n💾 Base64 não solicitado (settings.include_base64=false)")
             
             print(f"\n{'=' * 70}")
             print(f"✅ Teste concluído com sucesso!")
@@ -1,11 +1,28 @@
-from fastapi import FastAPI
-from router.router import route
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
+from router.router import route, start_clients, close_clients
 
-app = FastAPI(title="Blueprint MCP Core")
+app = FastAPI(title="Blueprint MCP Core", default_response_class=ORJSONResponse)
+
+@app.on_event("startup")
+async def on_startup():
+    await start_clients()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_clients()
 
 @app.post("/mcp")
-def mcp_entrypoint(request: dict):
-    return route(request)
+async def mcp_entrypoint(request: Request):
+    # corpo parseado direto com orjson (o router só repassa o payload ao agente)
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        return ORJSONResponse(status_code=400, content={"success": False, "error": f"Invalid JSON: {e}"})
+    if not isinstance(body, dict):
+        return ORJSONResponse(status_code=400, content={"success": False, "error": "Request body must be a JSON object"})
+    return await route(body)
 
 @app.get("/health")
 def health():
@@ -0,0 +1,58 @@
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import yaml
+
+# libyaml (C) quando disponível; senão o parser puro-Python do PyYAML
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+logger = logging.getLogger(__name__)
+
+AGENTS_FILE = Path(
+    os.getenv("MCP_AGENTS_FILE", Path(__file__).resolve().parents[2] / "registry" / "agents.yaml")
+)
+
+@lru_cache(maxsize=1)
+def _parse_agents(path: str, mtime_ns: int) -> dict:
+    with open(path, "rb") as f:
+        data = yaml.load(f, Loader=SafeLoader) or {}
+    return {agent["name"]: agent for agent in data.get("agents") or []}
+
+# último registry válido: um save malformado do agents.yaml não derruba o processo em execução
+_last_good: dict | None = None
+# mtime do arquivo que falhou (ou _MISSING se nem existe): o mesmo erro só é logado uma vez
+_failed_mtime_ns: int | None = None
+_MISSING = -1
+
+def load_agents() -> dict:
+    """
+    name -> configuração do agente. Só re-parseia o YAML quando o mtime do arquivo muda.
+    Se o arquivo novo não parseia, loga e segue com o último registry válido
+    (sem re-tentar nem re-logar até o próximo save; arquivo ausente também só loga uma vez).
+    Sem registry anterior, o erro sobe.
+    """
+    global _last_good, _failed_mtime_ns
+    path = str(AGENTS_FILE)
+    mtime_ns = None
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        if _last_good is not None and mtime_ns == _failed_mtime_ns:
+            return _last_good
+        agents = _parse_agents(path, mtime_ns)
+    except (OSError, yaml.YAMLError, AttributeError, KeyError, TypeError) as e:
+        if _last_good is None:
+            raise
+        failed = _MISSING if mtime_ns is None else mtime_ns
+        if failed == _failed_mtime_ns:
+            return _last_good
+        _failed_mtime_ns = failed
+        logger.error(f"agents.yaml inválido ({path}): {e} - mantendo o último registry válido")
+        return _last_good
+    _last_good = agents
+    _failed_mtime_ns = None
+    return agents
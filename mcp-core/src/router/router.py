@@ -1,10 +1,75 @@
-import requests
+import asyncio
+import os
+import time
+
+import httpx
+import orjson
 from registry.loader import load_agents
 
-agents = load_agents()
+# Um cliente por agente: cada um com seu pool keep-alive, sem um agente lento
+# esgotar as conexões dos outros. Criados no startup (e sob demanda para agentes
+# adicionados depois via hot reload) e fechados no shutdown.
+_clients: dict[str, httpx.AsyncClient] = {}
+
+# Circuit breaker por agente: após CIRCUIT_FAIL_MAX falhas seguidas, as chamadas
+# falham na hora por CIRCUIT_RESET_SECONDS em vez de esperar timeout_ms a cada request.
+CIRCUIT_FAIL_MAX = int(os.getenv("MCP_CIRCUIT_FAIL_MAX", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("MCP_CIRCUIT_RESET_SECONDS", "30"))
+_circuits: dict[str, dict] = {}
+
+def _client_for(agent_name: str) -> httpx.AsyncClient:
+    client = _clients.get(agent_name)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=16, max_connections=64),
+            timeout=httpx.Timeout(15.0),
+        )
+        _clients[agent_name] = client
+    return client
+
+async def start_clients():
+    for agent_name in load_agents():
+        _client_for(agent_name)
+
+async def close_clients():
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
+
+def _circuit_open(agent_name: str) -> bool:
+    state = _circuits.get(agent_name)
+    if not state or state["opened_at"] is None:
+        return False
+    if state["half_open_in_flight"]:
+        # já há uma sonda em andamento: os demais seguem falhando rápido até ela resolver
+        return True
+    if time.monotonic() - state["opened_at"] >= CIRCUIT_RESET_SECONDS:
+        # half-open: só esta chamada passa; sucesso fecha o circuito, falha reabre na hora.
+        # Sem await entre o teste e a marcação: no event loop único não há corrida
+        state["half_open_in_flight"] = True
+        return False
+    return True
+
+def _record_failure(agent_name: str):
+    state = _circuits.setdefault(agent_name, {"failures": 0, "opened_at": None, "half_open_in_flight": False})
+    state["half_open_in_flight"] = False
+    state["failures"] += 1
+    if state["failures"] >= CIRCUIT_FAIL_MAX:
+        state["opened_at"] = time.monotonic()
 
-def route(request: dict):
+def _abort_probe(agent_name: str):
+    # sonda cancelada (ex.: cliente desconectou) sem resultado: libera a próxima tentativa
+    state = _circuits.get(agent_name)
+    if state:
+        state["half_open_in_flight"] = False
+
+def _record_success(agent_name: str):
+    _circuits.pop(agent_name, None)
+
+async def route(request: dict):
     agent_name = request.get("agent")
+    # cache por mtime: alterações no agents.yaml valem sem reiniciar
+    agents = load_agents()
 
     if agent_name not in agents:
         return {
@@ -12,21 +77,37 @@ def route(request: dict):
             "error": f"Agent '{agent_name}' not registered"
         }
 
+    if _circuit_open(agent_name):
+        return {
+            "success": False,
+            "error": f"Agent '{agent_name}' unavailable (circuit open)"
+        }
+
     agent = agents[agent_name]
 
     try:
-        resp = requests.post(
+        resp = await _client_for(agent_name).post(
             agent["endpoint"],
             json=request.get("payload", {}),
             timeout=agent.get("timeout_ms", 15000) / 1000
         )
-        return {
-            "success": True,
-            "data": resp.json()
-        }
+        data = orjson.loads(resp.content)
+    except asyncio.CancelledError:
+        _abort_probe(agent_name)
+        raise
     except Exception as e:
+        _record_failure(agent_name)
         return {
             "success": False,
             "error": str(e)
         }
 
+    # 5xx conta como falha do agente para o breaker, mas a resposta segue repassada
+    if resp.status_code >= 500:
+        _record_failure(agent_name)
+    else:
+        _record_success(agent_name)
+    return {
+        "success": True,
+        "data": data
+    }
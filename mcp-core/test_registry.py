@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Script de teste do registry de agentes (hot reload por mtime + último registry válido)
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+# Adicionar src ao path (mesmo layout do import no container)
+SRC = Path(__file__).parent / "src"
+sys.path.insert(0, str(SRC))
+
+from registry import loader
+
+GOOD = "agents:\n  - name: echo\n    endpoint: http://echo.test/\n"
+GOOD_2 = "agents:\n  - name: echo\n    endpoint: http://echo.test/\n  - name: novo\n    endpoint: http://novo.test/\n"
+MALFORMED = "agents:\n  - name: [oops\n"
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def reset_loader(path: Path):
+    """Estado de processo recém-iniciado apontando para path."""
+    loader.AGENTS_FILE = path
+    loader._last_good = None
+    loader._failed_mtime_ns = None
+    loader._parse_agents.cache_clear()
+
+
+def write(path: Path, content: str, mtime_s: int):
+    # mtime explícito: garante mudança de mtime mesmo em filesystem de baixa resolução
+    path.write_text(content)
+    os.utime(path, ns=(mtime_s * 10**9, mtime_s * 10**9))
+
+
+def raises(fn) -> bool:
+    try:
+        fn()
+    except Exception:
+        return True
+    return False
+
+
+def test_registry():
+    """Testa fallback para o último registry válido e hot reload"""
+    print("=" * 60)
+    print("TESTE 1: Registry de agentes")
+    print("=" * 60)
+
+    errors = ErrorCounter()
+    logging.getLogger(loader.__name__).addHandler(errors)
+    checks = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "agents.yaml"
+
+        # primeira carga com arquivo ruim ou ausente: o erro sobe (não há registry anterior)
+        write(path, MALFORMED, 1_000)
+        reset_loader(path)
+        checks.append((raises(loader.load_agents), "YAML malformado na primeira carga levanta erro"))
+        reset_loader(Path(tmp) / "nao_existe.yaml")
+        checks.append((raises(loader.load_agents), "Arquivo ausente na primeira carga levanta erro"))
+
+        # carga válida
+        write(path, GOOD, 2_000)
+        reset_loader(path)
+        checks.append((sorted(loader.load_agents()) == ["echo"], "Carga válida"))
+
+        # save malformado: mantém o anterior e loga uma vez só
+        write(path, MALFORMED, 3_000)
+        first = sorted(loader.load_agents())
+        second = sorted(loader.load_agents())
+        checks.append((first == second == ["echo"], "YAML malformado mantém o registry anterior"))
+        checks.append((errors.count == 1, f"Erro do save malformado logado uma vez ({errors.count})"))
+
+        # arquivo some: mantém o anterior e também loga uma vez só
+        path.unlink()
+        missing = [sorted(loader.load_agents()) for _ in range(3)]
+        checks.append((all(m == ["echo"] for m in missing), "Arquivo ausente mantém o registry anterior"))
+        checks.append((errors.count == 2, f"Erro de arquivo ausente logado uma vez ({errors.count})"))
+
+        # arquivo volta válido (novo mtime): recarrega
+        write(path, GOOD_2, 4_000)
+        checks.append((sorted(loader.load_agents()) == ["echo", "novo"], "Arquivo válido tocado é recarregado"))
+        write(path, MALFORMED, 5_000)
+        loader.load_agents()
+        checks.append((errors.count == 3, "Novo save malformado volta a logar"))
+
+        # MCP_AGENTS_FILE: lido no import do loader
+        env = dict(os.environ, MCP_AGENTS_FILE=str(path), PYTHONPATH=str(SRC))
+        out = subprocess.run(
+            [sys.executable, "-c", "from registry import loader; print(loader.AGENTS_FILE)"],
+            env=env, capture_output=True, text=True,
+        ).stdout.strip()
+        checks.append((out == str(path), "MCP_AGENTS_FILE sobrescreve o caminho padrão"))
+
+    logging.getLogger(loader.__name__).removeHandler(errors)
+
+    all_passed = True
+    for passed, name in checks:
+        print(f"{'✓' if passed else '✗'} {name}")
+        if not passed:
+            all_passed = False
+    return all_passed
+
+
+def main():
+    """Executa todos os testes"""
+    tests = [
+        ("Registry de agentes", test_registry),
+    ]
+
+    results = []
+    for name, test_func in tests:
+        try:
+            results.append((name, test_func()))
+        except Exception as e:
+            print(f"\n✗ Erro no teste '{name}': {e}")
+            import traceback
+            traceback.print_exc()
+            results.append((name, False))
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTotal: {passed}/{len(results)} testes passaram")
+    return 0 if passed == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Script de teste do circuit breaker do router (agente simulado com httpx.MockTransport)
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+# Adicionar src ao path (mesmo layout do import no container)
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+
+from registry import loader
+from router import router
+
+AGENT = "flaky"
+
+
+class FakeAgent:
+    """Handler do MockTransport: modo "ok", "fail" (ConnectError) ou "hang" (espera release)."""
+
+    def __init__(self):
+        self.mode = "ok"
+        self.calls = 0
+        self.released = asyncio.Event()
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        if self.mode == "hang":
+            await self.released.wait()
+            raise httpx.ConnectError("agente não respondeu", request=request)
+        if self.mode == "fail":
+            raise httpx.ConnectError("agente fora do ar", request=request)
+        return httpx.Response(200, json={"echo": True})
+
+
+def is_circuit_open(resp: dict) -> bool:
+    return not resp["success"] and "circuit open" in resp["error"]
+
+
+async def run_breaker_checks() -> list:
+    agent = FakeAgent()
+    router._clients[AGENT] = httpx.AsyncClient(transport=httpx.MockTransport(agent))
+    router.CIRCUIT_FAIL_MAX = 3
+    router.CIRCUIT_RESET_SECONDS = 0.05
+    request = {"agent": AGENT, "payload": {}}
+    checks = []
+
+    # 1) abre após CIRCUIT_FAIL_MAX falhas seguidas; depois falha na hora, sem chamar o agente
+    agent.mode = "fail"
+    for _ in range(router.CIRCUIT_FAIL_MAX):
+        await router.route(request)
+    calls_before = agent.calls
+    resp = await router.route(request)
+    checks.append((is_circuit_open(resp) and agent.calls == calls_before, "Abre após N falhas"))
+
+    # 2) half-open: com várias chamadas concorrentes, só uma sonda chega ao agente
+    await asyncio.sleep(router.CIRCUIT_RESET_SECONDS + 0.01)
+    agent.mode = "hang"
+    calls_before = agent.calls
+    tasks = [asyncio.create_task(router.route(request)) for _ in range(5)]
+    await asyncio.sleep(0.01)
+    fast = [t.result() for t in tasks if t.done()]
+    checks.append((
+        len(fast) == 4 and all(map(is_circuit_open, fast)) and agent.calls == calls_before + 1,
+        "Half-open deixa passar uma única sonda",
+    ))
+    agent.released.set()
+    await asyncio.gather(*tasks)
+    resp = await router.route(request)
+    checks.append((is_circuit_open(resp), "Sonda que falha reabre o circuito"))
+
+    # 3) sonda cancelada (cliente desconectou) libera a vaga para a próxima tentativa
+    await asyncio.sleep(router.CIRCUIT_RESET_SECONDS + 0.01)
+    agent.released = asyncio.Event()
+    probe = asyncio.create_task(router.route(request))
+    await asyncio.sleep(0.01)
+    probe.cancel()
+    try:
+        await probe
+    except asyncio.CancelledError:
+        pass
+    checks.append((not router._circuits[AGENT]["half_open_in_flight"], "Sonda cancelada libera a vaga"))
+
+    # 4) próxima sonda com sucesso fecha o circuito (contagem de falhas zerada)
+    agent.mode = "ok"
+    resp = await router.route(request)
+    checks.append((resp["success"] and AGENT not in router._circuits, "Sucesso fecha o circuito"))
+
+    agent.mode = "fail"
+    resp = await router.route(request)
+    checks.append((not is_circuit_open(resp) and router._circuits[AGENT]["failures"] == 1, "Falhas recomeçam do zero"))
+
+    await router.close_clients()
+    return checks
+
+
+def test_circuit_breaker():
+    """Testa closed -> open -> half-open (sonda única) -> closed"""
+    print("=" * 60)
+    print("TESTE 1: Circuit breaker por agente")
+    print("=" * 60)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        agents_file = Path(tmp) / "agents.yaml"
+        agents_file.write_text(
+            f"agents:\n  - name: {AGENT}\n    endpoint: http://agent.test/\n    timeout_ms: 500\n"
+        )
+        loader.AGENTS_FILE = agents_file
+
+        start = time.perf_counter()
+        checks = asyncio.run(run_breaker_checks())
+        elapsed = time.perf_counter() - start
+
+    all_passed = True
+    for passed, name in checks:
+        print(f"{'✓' if passed else '✗'} {name}")
+        if not passed:
+            all_passed = False
+
+    print(f"\nTempo total: {elapsed:.2f}s")
+    return all_passed
+
+
+def main():
+    """Executa todos os testes"""
+    tests = [
+        ("Circuit breaker", test_circuit_breaker),
+    ]
+
+    results = []
+    for name, test_func in tests:
+        try:
+            results.append((name, test_func()))
+        except Exception as e:
+            print(f"\n✗ Erro no teste '{name}': {e}")
+            import traceback
+            traceback.print_exc()
+            results.append((name, False))
+
+    passed = sum(1 for _, result in results if result)
+    print(f"\nTotal: {passed}/{len(results)} testes passaram")
+    return 0 if passed == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())